@@ -1,3 +1,5 @@
+import functools
+import io
 import os
 import time
 from typing import Any, Optional
@@ -13,7 +15,7 @@ from cog.server.eventtypes import (
 )
 from cog.server.exceptions import FatalWorkerException, InvalidStateException
 from cog.server.worker import Worker
-from hypothesis import given, settings
+from hypothesis import Phase, given, settings
 from hypothesis import strategies as st
 from hypothesis.stateful import (
     RuleBasedStateMachine,
@@ -85,70 +87,157 @@ PREDICT_LOGS_FIXTURES = [
     )
 ]
 
+_DONE_CANCELED = Done(canceled=True)
+
 
 @define
 class Result:
     stdout: str = ""
     stderr: str = ""
     heartbeat_count: int = 0
+    done_count: int = 0
+    output_type_count: int = 0
+    output_count: int = 0
     output_type: Optional[PredictionOutputType] = None
     output: Any = None
     done: Optional[Done] = None
     exception: Optional[Exception] = None
 
 
+def _handle_log(event, result, stdout, stderr):
+    if event.source == "stdout":
+        stdout.write(event.message)
+    elif event.source == "stderr":
+        stderr.write(event.message)
+    else:
+        pytest.fail(f"saw unexpected event: {event}")
+
+
+def _handle_heartbeat(event, result, stdout, stderr):
+    result.heartbeat_count += 1
+
+
+def _handle_done(event, result, stdout, stderr):
+    result.done_count += 1
+    result.done = event
+
+
+def _handle_output(event, result, stdout, stderr):
+    # Ordering can't be checked once all events have been seen, so this one
+    # stays in the per-event path.
+    assert result.output_type, "Should get output type before any output"
+    result.output_count += 1
+    if result.output_type.multi:
+        result.output.append(event.payload)
+    else:
+        result.output = event.payload
+
+
+def _handle_output_type(event, result, stdout, stderr):
+    result.output_type_count += 1
+    result.output_type = event
+    if result.output_type.multi:
+        result.output = []
+
+
+def _check_result(result):
+    """
+    Check invariants over the whole event stream once it has been consumed.
+    """
+    assert result.done_count <= 1, f"Should not get multiple done events: {result}"
+    assert (
+        result.output_type_count <= 1
+    ), f"Should not get multiple output type events: {result}"
+    if result.output_type and not result.output_type.multi:
+        assert (
+            result.output_count <= 1
+        ), f"Should not get multiple outputs for output type single: {result}"
+
+
+_HANDLERS = {
+    Log: _handle_log,
+    Heartbeat: _handle_heartbeat,
+    Done: _handle_done,
+    PredictionOutput: _handle_output,
+    PredictionOutputType: _handle_output_type,
+}
+
+
 def _process(events, swallow_exceptions=False):
     """
     Helper function to collect events generated by Worker during tests.
     """
     result = Result()
-    stdout = []
-    stderr = []
+    stdout = io.StringIO()
+    stderr = io.StringIO()
 
     try:
         for event in events:
-            if isinstance(event, Log) and event.source == "stdout":
-                stdout.append(event.message)
-            elif isinstance(event, Log) and event.source == "stderr":
-                stderr.append(event.message)
-            elif isinstance(event, Heartbeat):
-                result.heartbeat_count += 1
-            elif isinstance(event, Done):
-                assert not result.done
-                result.done = event
-            elif isinstance(event, PredictionOutput):
-                assert result.output_type, "Should get output type before any output"
-                if result.output_type.multi:
-                    result.output.append(event.payload)
-                else:
-                    assert (
-                        result.output is None
-                    ), "Should not get multiple outputs for output type single"
-                    result.output = event.payload
-            elif isinstance(event, PredictionOutputType):
-                assert (
-                    result.output_type is None
-                ), "Should not get multiple output type events"
-                result.output_type = event
-                if result.output_type.multi:
-                    result.output = []
-            else:
+            handler = _HANDLERS.get(type(event))
+            if handler is None:
                 pytest.fail(f"saw unexpected event: {event}")
+            handler(event, result, stdout, stderr)
+        _check_result(result)
     except Exception as exc:
         result.exception = exc
         if not swallow_exceptions:
             raise
-    result.stdout = "".join(stdout)
-    result.stderr = "".join(stderr)
+    result.stdout = stdout.getvalue()
+    result.stderr = stderr.getvalue()
     return result
 
 
+@functools.lru_cache(maxsize=None)
 def _fixture_path(name):
     test_dir = os.path.dirname(os.path.realpath(__file__))
     return os.path.join(test_dir, f"fixtures/{name}.py") + ":Predictor"
 
 
-@pytest.mark.parametrize("name,payloads", SETUP_FATAL_FIXTURES)
+@pytest.fixture(scope="module")
+def worker(request):
+    """
+    A Worker which has already been set up, shared by every test in the
+    module that uses the same predictor. Use with indirect parametrization
+    (the parameter is the fixture name) for tests which leave the worker in a
+    reusable state.
+    """
+    w = Worker(predictor_ref=_fixture_path(request.param), tee_output=False)
+
+    try:
+        result = _process(w.setup())
+        assert not result.done.error
+
+        yield w
+    finally:
+        w.terminate()
+
+
+def _ids(fixtures):
+    """
+    Test IDs for a fixture table: the name of the predictor in each row.
+    """
+    return [f[0] for f in fixtures]
+
+
+def _worker_params(fixtures):
+    """
+    Parameters for tests using the worker fixture. Each row is put in an xdist
+    group named after its predictor so that, under `--dist loadgroup`, tests
+    sharing a predictor run on the same xdist worker and it is only set up
+    once.
+    """
+    return [
+        pytest.param(*f, id=f[0], marks=pytest.mark.xdist_group(f[0])) for f in fixtures
+    ]
+
+
+def uses_worker(name):
+    return pytest.mark.parametrize("worker", _worker_params([(name,)]), indirect=True)
+
+
+@pytest.mark.parametrize(
+    "name,payloads", SETUP_FATAL_FIXTURES, ids=_ids(SETUP_FATAL_FIXTURES)
+)
 def test_fatalworkerexception_from_setup_failures(name, payloads):
     """
     Any failure during setup is fatal and should raise FatalWorkerException.
@@ -161,7 +250,11 @@ def test_fatalworkerexception_from_setup_failures(name, payloads):
     w.terminate()
 
 
-@pytest.mark.parametrize("name,payloads", PREDICTION_FATAL_FIXTURES)
+@pytest.mark.parametrize(
+    "name,payloads",
+    PREDICTION_FATAL_FIXTURES,
+    ids=_ids(PREDICTION_FATAL_FIXTURES),
+)
 @given(data=st.data())
 def test_fatalworkerexception_from_irrecoverable_failures(data, name, payloads):
     """
@@ -181,51 +274,47 @@ def test_fatalworkerexception_from_irrecoverable_failures(data, name, payloads):
     w.terminate()
 
 
-@pytest.mark.parametrize("name,payloads", RUNNABLE_FIXTURES)
+@pytest.mark.parametrize(
+    "worker,payloads",
+    _worker_params(RUNNABLE_FIXTURES),
+    indirect=["worker"],
+)
 @given(data=st.data())
-def test_no_exceptions_from_recoverable_failures(data, name, payloads):
+def test_no_exceptions_from_recoverable_failures(data, worker, payloads):
     """
     Well-behaved predictors, or those that only throw exceptions, should not
     raise.
     """
-    w = Worker(predictor_ref=_fixture_path(name), tee_output=False)
-
-    try:
-        result = _process(w.setup())
-        assert not result.done.error
-
-        for _ in range(5):
-            payload = data.draw(st.fixed_dictionaries(payloads))
-            _process(w.predict(payload))
-    finally:
-        w.terminate()
+    for _ in range(5):
+        payload = data.draw(st.fixed_dictionaries(payloads))
+        _process(worker.predict(payload))
 
 
-@pytest.mark.parametrize("name,payloads,output_generator", OUTPUT_FIXTURES)
+@pytest.mark.parametrize(
+    "worker,payloads,output_generator",
+    _worker_params(OUTPUT_FIXTURES),
+    indirect=["worker"],
+)
 @given(data=st.data())
-def test_output(data, name, payloads, output_generator):
+def test_output(data, worker, payloads, output_generator):
     """
     We should get the outputs we expect from predictors that generate output.
 
     Note that most of the validation work here is actually done in _process.
     """
-    w = Worker(predictor_ref=_fixture_path(name), tee_output=False)
+    payload = data.draw(st.fixed_dictionaries(payloads))
+    expected_output = output_generator(payload)
 
-    try:
-        result = _process(w.setup())
-        assert not result.done.error
+    result = _process(worker.predict(payload))
 
-        payload = data.draw(st.fixed_dictionaries(payloads))
-        expected_output = output_generator(payload)
+    assert result.output == expected_output
 
-        result = _process(w.predict(payload))
 
-        assert result.output == expected_output
-    finally:
-        w.terminate()
-
-
-@pytest.mark.parametrize("name,expected_stdout,expected_stderr", SETUP_LOGS_FIXTURES)
+@pytest.mark.parametrize(
+    "name,expected_stdout,expected_stderr",
+    SETUP_LOGS_FIXTURES,
+    ids=_ids(SETUP_LOGS_FIXTURES),
+)
 def test_setup_logging(name, expected_stdout, expected_stderr):
     """
     We should get the logs we expect from predictors that generate logs during
@@ -244,25 +333,19 @@ def test_setup_logging(name, expected_stdout, expected_stderr):
 
 
 @pytest.mark.parametrize(
-    "name,payloads,expected_stdout,expected_stderr", PREDICT_LOGS_FIXTURES
+    "worker,payloads,expected_stdout,expected_stderr",
+    _worker_params(PREDICT_LOGS_FIXTURES),
+    indirect=["worker"],
 )
-def test_predict_logging(name, payloads, expected_stdout, expected_stderr):
+def test_predict_logging(worker, payloads, expected_stdout, expected_stderr):
     """
     We should get the logs we expect from predictors that generate logs during
     predict.
     """
-    w = Worker(predictor_ref=_fixture_path(name), tee_output=False)
+    result = _process(worker.predict({}))
 
-    try:
-        result = _process(w.setup())
-        assert not result.done.error
-
-        result = _process(w.predict({}))
-
-        assert result.stdout == expected_stdout
-        assert result.stderr == expected_stderr
-    finally:
-        w.terminate()
+    assert result.stdout == expected_stdout
+    assert result.stderr == expected_stderr
 
 
 def test_cancel_is_safe():
@@ -271,7 +354,7 @@ def test_cancel_is_safe():
     happening or the cancelation of unexpected predictions.
     """
 
-    w = Worker(predictor_ref=_fixture_path("sleep"), tee_output=True)
+    w = Worker(predictor_ref=_fixture_path("sleep"), tee_output=False)
 
     try:
         for _ in range(50):
@@ -298,117 +381,91 @@ def test_cancel_is_safe():
         w.terminate()
 
 
-def test_cancel_idempotency():
+@uses_worker("sleep")
+def test_cancel_idempotency(worker):
     """
     Multiple calls to cancel within the same prediction, while not necessary or
     recommended, should still only result in a single cancelled prediction, and
     should not affect subsequent predictions.
     """
-    w = Worker(predictor_ref=_fixture_path("sleep"), tee_output=True)
+    p1_done = None
 
-    try:
-        _process(w.setup())
+    for event in worker.predict({"sleep": 0.5}, poll=0.01):
+        # We call cancel a WHOLE BUNCH to make sure that we don't propagate
+        # any of those cancelations to subsequent predictions, regardless
+        # of the internal implementation of exceptions raised inside signal
+        # handlers.
+        for _ in range(100):
+            worker.cancel()
 
-        p1_done = None
+        if isinstance(event, Done):
+            p1_done = event
 
-        for event in w.predict({"sleep": 0.5}, poll=0.01):
-            # We call cancel a WHOLE BUNCH to make sure that we don't propagate
-            # any of those cancelations to subsequent predictions, regardless
-            # of the internal implementation of exceptions raised inside signal
-            # handlers.
-            for _ in range(100):
-                w.cancel()
+    assert p1_done.canceled
 
-            if isinstance(event, Done):
-                p1_done = event
+    result2 = _process(worker.predict({"sleep": 0.1}))
 
-        assert p1_done.canceled
+    assert not result2.done.canceled
+    assert result2.output == "done in 0.1 seconds"
 
-        result2 = _process(w.predict({"sleep": 0.1}))
 
-        assert not result2.done.canceled
-        assert result2.output == "done in 0.1 seconds"
-    finally:
-        w.terminate()
-
-
-def test_cancel_multiple_predictions():
+@uses_worker("sleep")
+def test_cancel_multiple_predictions(worker):
     """
     Multiple predictions cancelled in a row shouldn't be a problem. This test
     is mainly ensuring that the _allow_cancel latch in Worker is correctly
     reset every time a prediction starts.
     """
+    dones = []
 
-    w = Worker(predictor_ref=_fixture_path("sleep"), tee_output=True)
-
-    try:
-        _process(w.setup())
-
-        dones = []
+    for _ in range(5):
+        canceled = False
 
-        for _ in range(5):
-            canceled = False
+        for event in worker.predict({"sleep": 0.5}, poll=0.01):
+            if not canceled:
+                worker.cancel()
+                canceled = True
 
-            for event in w.predict({"sleep": 0.5}, poll=0.01):
-                if not canceled:
-                    w.cancel()
-                    canceled = True
+            if isinstance(event, Done):
+                dones.append(event)
 
-                if isinstance(event, Done):
-                    dones.append(event)
-
-        assert len(dones) == 5
-        assert all([d == Done(canceled=True) for d in dones])
-    finally:
-        w.terminate()
+    assert len(dones) == 5
+    assert all(d == _DONE_CANCELED for d in dones)
 
 
-def test_heartbeats():
+@uses_worker("sleep")
+def test_heartbeats(worker):
     """
     Passing the `poll` keyword argument to predict should result in regular
     heartbeat events which allow the caller to do other stuff while waiting on
     completion.
     """
-    w = Worker(predictor_ref=_fixture_path("sleep"), tee_output=False)
+    result = _process(worker.predict({"sleep": 0.5}, poll=0.1))
 
-    try:
-        _process(w.setup())
+    assert result.heartbeat_count > 0
 
-        result = _process(w.predict({"sleep": 0.5}, poll=0.1))
 
-        assert result.heartbeat_count > 0
-    finally:
-        w.terminate()
-
-
-def test_heartbeats_cancel():
+@uses_worker("sleep")
+def test_heartbeats_cancel(worker):
     """
     Heartbeats should happen even when we cancel the prediction.
     """
+    heartbeat_count = 0
+    start = time.monotonic()
+    deadline = start + 0.5
 
-    w = Worker(predictor_ref=_fixture_path("sleep"), tee_output=False)
-
-    try:
-        _process(w.setup())
+    canceled = False
+    for event in worker.predict({"sleep": 10}, poll=0.1):
+        if isinstance(event, Heartbeat):
+            heartbeat_count += 1
+        if not canceled and time.monotonic() > deadline:
+            worker.cancel()
+            canceled = True
 
-        heartbeat_count = 0
-        start = time.time()
+    elapsed = time.monotonic() - start
 
-        canceled = False
-        for event in w.predict({"sleep": 10}, poll=0.1):
-            if isinstance(event, Heartbeat):
-                heartbeat_count += 1
-            if time.time() - start > 0.5:
-                if not canceled:
-                    w.cancel()
-                    canceled = True
-
-        elapsed = time.time() - start
-
-        assert elapsed < 2
-        assert heartbeat_count > 0
-    finally:
-        w.terminate()
+    assert elapsed < 2
+    assert heartbeat_count > 0
 
 
 def test_graceful_shutdown():
@@ -475,9 +532,10 @@ class WorkerState(RuleBasedStateMachine):
     @precondition(lambda x: x.setup_generator)
     @rule(n=st.integers(min_value=1, max_value=10))
     def read_setup_events(self, n):
+        next_event = self.setup_generator.__next__
         try:
             for _ in range(n):
-                event = next(self.setup_generator)
+                event = next_event()
                 self.setup_events.append(event)
         except StopIteration:
             self.setup_generator = None
@@ -506,9 +564,10 @@ class WorkerState(RuleBasedStateMachine):
     @precondition(lambda x: x.predict_generator)
     @rule(n=st.integers(min_value=1, max_value=10))
     def read_predict_events(self, n):
+        next_event = self.predict_generator.__next__
         try:
             for _ in range(n):
-                event = next(self.predict_generator)
+                event = next_event()
                 self.predict_events.append(event)
         except StopIteration:
             self.predict_generator = None
@@ -553,3 +612,10 @@ class WorkerState(RuleBasedStateMachine):
 
 
 TestWorkerState = WorkerState.TestCase
+# Each shrink attempt re-runs the machine against a real predictor process, so
+# shrinking a failure is very slow. Skip the shrink phase and keep runs short.
+TestWorkerState.settings = settings(
+    TestWorkerState.settings,
+    phases=[p for p in Phase if p is not Phase.shrink],
+    stateful_step_count=20,
+)